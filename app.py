@@ -2,10 +2,13 @@
 import streamlit as st
 import pandas as pd
 import geopandas as gpd
+import numpy as np
+import pyarrow.parquet as pq
 from pathlib import Path
 from streamlit_folium import st_folium
 import folium
-import altair as alt
+from folium.plugins import FastMarkerCluster, VectorGridProtobuf
+from folium.template import Template
 import re
 
 # --- put this at the very top of app.py ---
@@ -31,45 +34,80 @@ st.set_page_config(page_title="Indiana Truck Parking -- County Dashboard", layou
 
 # DATA_DIR = Path("data")
 DAILY_CSV = Path("indiana_county_daily.csv")
-COUNTIES_GEOJSON = Path("indiana_counties_500k.geojson")
+COUNTIES_PARQUET = Path("indiana_counties_500k.parquet")     # GeoParquet
 #updated to the latest data 
 RAW_HOURLY_CSV = Path("in_parking_demand_data_ver0.parquet")# used for stacked bars & hourly download
-SPOTS_GEOJSON = Path("IN_Truck_Spots.geojson")            # backend truck parking spots
-ROADWAYS_GEOJSON = Path("in_roadway_map_layer.geojson")   # roadway lines (no tooltip)
+SPOTS_PARQUET = Path("IN_Truck_Spots.parquet")            # backend truck parking spots (GeoParquet)
+ROADWAYS_PARQUET = Path("in_roadway_map_layer.parquet")   # roadway lines (no tooltip, GeoParquet)
+
+# Douglas-Peucker tolerances (degrees, EPSG:4326); ~500 m / ~200 m at IN latitude
+COUNTY_SIMPLIFY_TOL = 0.005
+ROADWAY_SIMPLIFY_TOL = 0.002
 
 # ---------- cached loaders ----------
 @st.cache_data(show_spinner=False)
 def load_daily():
     return pd.read_csv(DAILY_CSV, dtype={"county_fips": str})
 
+@st.cache_data(show_spinner=False)
+def load_supply():
+    """county_fips -> fixed hourly supply, plus the statewide total (for the stacked chart / download)."""
+    supply_map = load_daily().set_index("county_fips")["supply"].fillna(0).to_dict()
+    return supply_map, float(sum(supply_map.values()))
+
 @st.cache_data(show_spinner=False)
 def load_counties():
-    gdf = gpd.read_file(COUNTIES_GEOJSON)
+    gdf = gpd.read_parquet(COUNTIES_PARQUET, columns=["county_fips", "county_name", "geometry"])
+    gdf["geometry"] = gdf.geometry.simplify(COUNTY_SIMPLIFY_TOL, preserve_topology=True)
     gdf["county_fips"] = gdf["county_fips"].astype(str).str.zfill(5)
     return gdf
 
+# the parquet is stored typed (county: zero-padded string, hour: int64,
+# demand/supply: float64, no nulls), so no per-column coercion is needed
+HOURLY_COLUMNS = ["county", "hour", "des_demand", "undes_demand", "supply"]
+
 @st.cache_data(show_spinner=False)
 def load_hourly():
-    df = pd.read_parquet(RAW_HOURLY_CSV)
-    #some quick processing for the new data format
-    df = df.drop(columns = {"county_name"})
-    df.columns = ["county","hour","des_demand", "undes_demand", "supply"]
-    df.columns = [c.strip().lower() for c in df.columns]
-    df["county"] = df["county"].astype(str).str.zfill(5)
-    df["hour"] = df["hour"].astype(int)
-    for c in ["des_demand", "undes_demand", "supply"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0)
-    return df
+    """County-indexed hourly table (only read on a per-county cache miss)."""
+    tbl = pq.read_table(RAW_HOURLY_CSV, columns=HOURLY_COLUMNS)
+    return tbl.to_pandas(types_mapper=pd.ArrowDtype).set_index("county").sort_index()
+
+@st.cache_data(show_spinner=False)
+def load_hourly_statewide():
+    """24-row statewide demand by hour (the default chart)."""
+    tbl = pq.read_table(RAW_HOURLY_CSV, columns=HOURLY_COLUMNS)
+    # statewide sums by hour on the Arrow table; only the 24-row result goes to pandas
+    return (
+        tbl.group_by("hour")
+           .aggregate([("des_demand", "sum"), ("undes_demand", "sum")])
+           .select(["hour", "des_demand_sum", "undes_demand_sum"])
+           .rename_columns(["hour", "des_demand", "undes_demand"])
+           .sort_by("hour")
+           .to_pandas(types_mapper=pd.ArrowDtype)
+    )
+
+@st.cache_data(show_spinner=False)
+def load_hourly_for(fips):
+    """One county's 24 rows, sliced from the county index (no full-table mask)."""
+    df = load_hourly()
+    if fips not in df.index:
+        return df.iloc[:0]
+    return df.loc[[fips]]
 
 @st.cache_data(show_spinner=False)
 def load_spots(path: Path):
+    """Returns (coords, err); coords is an (n, 2) float32 [lat, lon] array."""
     if not path.exists():
         return None, f"Spots file not found: {path}"
     try:
-        gdf = gpd.read_file(path).to_crs(epsg=4326)
+        gdf = gpd.read_parquet(path, columns=["geometry"]).to_crs(epsg=4326)
         # keep only points; ignore other geometries if any
         gdf = gdf[gdf.geometry.notna() & gdf.geometry.geom_type.eq("Point")].copy()
-        return gdf, None
+        coords = np.column_stack([
+            gdf.geometry.y.to_numpy(np.float32),
+            gdf.geometry.x.to_numpy(np.float32),
+        ])
+        return coords, None
     except Exception as e:
         return None, f"Could not read truck spots ({path.name}): {e}"
 
@@ -78,19 +116,122 @@ def load_roadways(path: Path):
     if not path.exists():
         return None, f"Roadways file not found: {path}"
     try:
-        gdf = gpd.read_file(path).to_crs(epsg=4326)
+        gdf = gpd.read_parquet(path, columns=["geometry"]).to_crs(epsg=4326)
         # keep only line-ish geometries
         gdf = gdf[gdf.geometry.notna() & gdf.geometry.geom_type.isin(["LineString", "MultiLineString"])].copy()
+        gdf["geometry"] = gdf.geometry.simplify(ROADWAY_SIMPLIFY_TOL, preserve_topology=True)
         return gdf, None
     except Exception as e:
         return None, f"Could not read roadways ({path.name}): {e}"
 
+@st.cache_data(show_spinner=False)
+def prepare_gdf(_counties, _daily):
+    """Counties joined to daily metrics + *_fmt display columns (inputs are cached loader output, not hashed)."""
+    gdf_joined = _counties.merge(_daily, on="county_fips", how="left")
+    num_cols = [c for c in _daily.columns if c not in ("diagnosis", "county_fips")]
+    for c in num_cols:
+        if c in gdf_joined:
+            gdf_joined[c] = pd.to_numeric(gdf_joined[c], errors="coerce").fillna(0)
+
+    # --- Create *_fmt (integer) columns for tooltip display only ---
+    fmt_targets = [
+        "max_hourly_des_demand",
+        "max_hourly_undes_demand",
+        "max_hourly_total_demand",
+        "acc_des_demand",
+        "acc_undes_demand",
+        "acc_total_demand",
+        "supply",
+        "max_hourly_des_deficit",
+        "max_hourly_total_deficit",
+        "acc_des_deficit",
+        "acc_total_deficit",
+    ]
+    present = [c for c in fmt_targets if c in gdf_joined.columns]
+    missing = [c for c in fmt_targets if c not in gdf_joined.columns]
+    # one block-wise round/cast instead of one per column
+    fmt_block = gdf_joined[present].round(0).astype("int64")
+    fmt_block.columns = [f"{c}_fmt" for c in present]
+    gdf_joined = pd.concat([gdf_joined, fmt_block], axis=1)
+    if missing:
+        gdf_joined = gdf_joined.assign(**{f"{c}_fmt": 0 for c in missing})
+    return gdf_joined
+
+def hourly_long(fips, statewide_24, fips_to_name):
+    supply_map, statewide_supply = load_supply()
+    if fips:
+        sub = load_hourly_for(fips)
+        title = fips_to_name.get(fips, f"County {fips}")
+        # supply constant for this county from daily metrics
+        supply_const = float(supply_map.get(fips, 0.0))
+        # aggregate demand by hour
+        agg = sub.groupby("hour", as_index=False)[["des_demand", "undes_demand"]].sum()
+    else:
+        title = "Indiana (statewide)"
+        # statewide supply = sum of county supplies (constant across hours)
+        supply_const = statewide_supply
+        # already aggregated by hour in load_hourly_statewide
+        agg = statewide_24.copy()
+
+    # set constant supply per hour
+    agg["supply"] = supply_const
+
+    # long form for stacked bars (Designated bottom, Undesignated top)
+    long_df = agg.melt(
+        id_vars="hour",
+        value_vars=["des_demand", "undes_demand"],
+        var_name="type",
+        value_name="value"
+    ).replace({"type": {"des_demand": "Designated", "undes_demand": "Undesignated"}})
+
+    return title, long_df.sort_values("hour"), agg[["hour", "des_demand", "undes_demand", "supply"]]
+
+# melted chart data per county (None = statewide), reshaped once and memoized;
+# the data args are cached loader output, so only the FIPS is hashed
+@st.cache_data(show_spinner=False)
+def bars_for(fips, _statewide_24, _fips_to_name):
+    title, bars_long, table = hourly_long(fips, _statewide_24, _fips_to_name)
+    # enforce stack order + integer formatting for visuals
+    bars_long["type_order"] = bars_long["type"].map({"Designated": 0, "Undesignated": 1})
+    return title, bars_long, table
+
+# encoded hourly download per county, so reruns don't re-format the CSV
+@st.cache_data(show_spinner=False)
+def csv_bytes_for(fips, _statewide_24, _fips_to_name):
+    _, _, table = bars_for(fips, _statewide_24, _fips_to_name)
+    return table.to_csv(index=False).encode("utf-8")
+
 # ---------- map builders ----------
+# Display-only integer columns already prepared as *_fmt
+COUNTY_TOOLTIP_FIELDS = [
+    ("County", "county_name"),
+    ("FIPS", "county_fips"),
+    ("Max hourly des. demand", "max_hourly_des_demand_fmt"),
+    ("Max hourly undes. demand", "max_hourly_undes_demand_fmt"),
+    ("Max hourly total demand", "max_hourly_total_demand_fmt"),
+    ("Acc. des. demand (truck-hrs)", "acc_des_demand_fmt"),
+    ("Acc. undes. demand (truck-hrs)", "acc_undes_demand_fmt"),
+    ("Acc. total demand (truck-hrs)", "acc_total_demand_fmt"),
+    ("Supply (hourly fixed)", "supply_fmt"),
+    ("Max hourly des. deficit", "max_hourly_des_deficit_fmt"),
+    ("Max hourly total deficit", "max_hourly_total_deficit_fmt"),
+    ("Acc. des. deficit (truck-hrs)", "acc_des_deficit_fmt"),
+    ("Acc. total deficit (truck-hrs)", "acc_total_deficit_fmt"),
+    ("Diagnosis", "diagnosis"),
+]
+# what the county layer serializes: tooltip/popup fields (incl. county_fips) + shapes
+COUNTY_LAYER_COLUMNS = [f for _, f in COUNTY_TOOLTIP_FIELDS] + ["geometry"]
+
+@st.cache_data(show_spinner=False)
+def county_layer_geojson(_gdf_joined):
+    """County shapes + tooltip fields; metric values are joined in by Choropleth."""
+    return _gdf_joined[COUNTY_LAYER_COLUMNS].to_json()
+
 def make_numeric_choropleth(gdf_joined, color_col, legend_label):
     m = folium.Map(location=[39.9, -86.3], zoom_start=7, tiles="cartodbpositron")
-    folium.Choropleth(
-        geo_data=gdf_joined.to_json(),
-        data=gdf_joined,
+    cp = folium.Choropleth(
+        geo_data=county_layer_geojson(gdf_joined),
+        data=gdf_joined[["county_fips", color_col]],
         columns=["county_fips", color_col],
         key_on="feature.properties.county_fips",
         fill_color="YlOrRd",
@@ -98,7 +239,12 @@ def make_numeric_choropleth(gdf_joined, color_col, legend_label):
         line_opacity=0.6,
         nan_fill_color="#cccccc",
         legend_name=legend_label,
-    ).add_to(m)
+        name="Counties",
+        highlight=True,
+    )
+    # tooltip + popup ride on the choropleth's own GeoJson (no second county layer)
+    attach_tooltip_and_popup(cp.geojson)
+    cp.add_to(m)
     return m
 
 def make_categorical_map(gdf_joined, category_col, palette=None):
@@ -111,12 +257,19 @@ def make_categorical_map(gdf_joined, category_col, palette=None):
         }
     m = folium.Map(location=[39.9, -86.3], zoom_start=7, tiles="cartodbpositron")
 
-    def style_fn(feat):
-        cat = feat["properties"].get(category_col, None)
-        color = palette.get(cat, "#8c8c8c")
-        return {"fillColor": color, "color": "#555", "weight": 0.8, "fillOpacity": 0.8}
+    # resolve colors once (vectorized) and carry them as a feature property,
+    # so the style function is a plain lookup and the layer is static data
+    styled = gdf_joined[COUNTY_LAYER_COLUMNS].assign(
+        _fill=gdf_joined[category_col].map(palette).fillna("#8c8c8c")
+    )
 
-    gj = folium.GeoJson(gdf_joined, style_function=style_fn, name="Diagnosis")
+    gj = folium.GeoJson(
+        styled,
+        style_function=lambda f: {"fillColor": f["properties"]["_fill"], "color": "#555", "weight": 0.8, "fillOpacity": 0.8},
+        highlight_function=lambda x: {"weight": 2, "color": "black"},
+        name="Diagnosis",
+    )
+    attach_tooltip_and_popup(gj)
     gj.add_to(m)
     # build a simple categorical legend
     legend_html = """
@@ -129,76 +282,142 @@ def make_categorical_map(gdf_joined, category_col, palette=None):
     m.get_root().html.add_child(folium.Element(legend_html))
     return m
 
-def attach_tooltip_and_popup(m, gdf_joined):
-    # Display-only integer columns already prepared as *_fmt
-    fields = [
-        ("County", "county_name"),
-        ("FIPS", "county_fips"),
-        ("Max hourly des. demand", "max_hourly_des_demand_fmt"),
-        ("Max hourly undes. demand", "max_hourly_undes_demand_fmt"),
-        ("Max hourly total demand", "max_hourly_total_demand_fmt"),
-        ("Acc. des. demand (truck-hrs)", "acc_des_demand_fmt"),
-        ("Acc. undes. demand (truck-hrs)", "acc_undes_demand_fmt"),
-        ("Acc. total demand (truck-hrs)", "acc_total_demand_fmt"),
-        ("Supply (hourly fixed)", "supply_fmt"),
-        ("Max hourly des. deficit", "max_hourly_des_deficit_fmt"),
-        ("Max hourly total deficit", "max_hourly_total_deficit_fmt"),
-        ("Acc. des. deficit (truck-hrs)", "acc_des_deficit_fmt"),
-        ("Acc. total deficit (truck-hrs)", "acc_total_deficit_fmt"),
-        ("Diagnosis", "diagnosis"),
-    ]
-
-    tooltip = folium.features.GeoJsonTooltip(
-        fields=[f for _, f in fields],
-        aliases=[a for a, _ in fields],
+def attach_tooltip_and_popup(gj):
+    """Hover tooltip + FIPS popup on an existing county GeoJson layer."""
+    folium.features.GeoJsonTooltip(
+        fields=[f for _, f in COUNTY_TOOLTIP_FIELDS],
+        aliases=[a for a, _ in COUNTY_TOOLTIP_FIELDS],
         sticky=True,
         localize=True,
         labels=True,    # keep the "Label: value" format
         # no style override — use Leaflet defaults
-    )
-
-    gj = folium.GeoJson(
-        gdf_joined,
-        name="Counties",
-        style_function=lambda _: {"fillOpacity": 0, "color": "#555", "weight": 0.8},
-        highlight_function=lambda x: {"weight": 2, "color": "black"},
-        tooltip=tooltip,
-    )
+    ).add_to(gj)
     folium.GeoJsonPopup(fields=["county_fips"]).add_to(gj)
-    gj.add_to(m)
 
 
 
+class VectorGridSlicer(VectorGridProtobuf):
+    """Leaflet.VectorGrid layer tiled in the browser (geojson-vt) from inline GeoJSON.
+
+    Same plugin/JS bundle as VectorGridProtobuf, but ``L.vectorGrid.slicer``
+    cuts the GeoJSON into per-zoom simplified canvas tiles client-side, so no
+    pre-built .pbf tiles or tile server are needed.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) -%}
+        var {{ this.get_name() }} = L.vectorGrid.slicer(
+            {{ this.data|tojson }},
+            {{ this.options }}
+        );
+        {%- endmacro %}
+        """
+    )
+
+    def __init__(self, data, options, name=None, control=True, show=True):
+        super().__init__(url="", name=name, options=options, control=control, show=show)
+        self._name = "VectorGridSlicer"
+        self.data = data
+
+# Leaflet puts grid layers in tilePane (z 200), under the county fills in
+# overlayPane (z 400); own panes keep the order counties -> roadways -> spots
+ROADWAYS_PANE, ROADWAYS_Z = "roadways", 450
+TRUCK_SPOTS_PANE, TRUCK_SPOTS_Z = "truck_spots", 460
+
+# one sliced layer ("sliced" is VectorGrid's default layer name for slicer input)
+ROADWAY_TILE_OPTIONS = """{
+    pane: "%s",
+    rendererFactory: L.canvas.tile,
+    maxZoom: 18,
+    vectorTileLayerStyles: {
+        sliced: {color: "#4d4d4d", weight: 1.0, opacity: 0.8}
+    }
+}""" % ROADWAYS_PANE
+
 def add_roadways_layer(m, road_gdf):
     """Add roadways (lines) as a toggleable layer (ON by default), no tooltip."""
     if road_gdf is None or road_gdf.empty:
         return
+    folium.map.CustomPane(ROADWAYS_PANE, z_index=ROADWAYS_Z).add_to(m)  # no pointer events: clicks reach counties
     fg = folium.FeatureGroup(name="Roadways", show=True)
-    # simple styling; you can extend with color by 'highway' type if desired
-    folium.GeoJson(
-        road_gdf,
-        name="Roadways",
-        style_function=lambda _: {"color": "#4d4d4d", "weight": 1.0, "opacity": 0.8},
+    # vector tiles: only tiles in view are drawn, simplified per zoom level
+    VectorGridSlicer(
+        road_gdf[["geometry"]].__geo_interface__,
+        options=ROADWAY_TILE_OPTIONS,
+        control=False,  # toggled through the FeatureGroup
     ).add_to(fg)
     fg.add_to(m)
 
-def add_truck_spots_layer(m, spots_gdf):
-    """Add spots as a toggleable layer (ON by default), no tooltip/popup."""
-    if spots_gdf is None or spots_gdf.empty:
+SPOT_MARKER_CALLBACK = """
+function (row) {
+    return L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 2.5, weight: 0, fill: true, fillOpacity: 0.8, pane: "%s"
+    });
+}
+""" % TRUCK_SPOTS_PANE
+
+def add_truck_spots_layer(m, spots_xy):
+    """Add spots (n x 2 [lat, lon] array) as a toggleable layer (ON by default), no tooltip/popup."""
+    if spots_xy is None or len(spots_xy) == 0:
         return
+    folium.map.CustomPane(TRUCK_SPOTS_PANE, z_index=TRUCK_SPOTS_Z, pointer_events=True).add_to(m)
     fg = folium.FeatureGroup(name="Truck parking spots", show=True)
-    for _, r in spots_gdf.iterrows():
-        geom = r.geometry
-        if geom and geom.geom_type == "Point":
-            folium.CircleMarker(
-                location=[geom.y, geom.x],
-                radius=2.5,
-                weight=0,
-                fill=True,
-                fill_opacity=0.8,
-            ).add_to(fg)
+    # one coordinate payload + one JS callback instead of a CircleMarker per row;
+    # 5 decimals (~1 m) keeps float32 noise digits out of the JSON
+    FastMarkerCluster(
+        spots_xy.astype(np.float64).round(5).tolist(),
+        callback=SPOT_MARKER_CALLBACK,
+        options={"disableClusteringAtZoom": 1},  # keep every spot visible, as before
+    ).add_to(fg)
     fg.add_to(m)
 
+# Built once per metric and reused across reruns (clicks, clear, etc.);
+# the map doesn't depend on the selected county, and the data args are
+# themselves cached so they're excluded from the key (leading underscore).
+@st.cache_resource(max_entries=32, show_spinner=False)
+def build_map(metric_label, _gdf_joined, _road_gdf, _spots_xy):
+    if metric_label == "Diagnosis":
+        m = make_categorical_map(_gdf_joined, "diagnosis")
+    else:
+        m = make_numeric_choropleth(
+            _gdf_joined,
+            color_col=metric_label_to_key[metric_label],
+            legend_label=metric_label
+        )
+
+    # --- Layer order: heatmap/categorical -> Roadways -> Spots ---
+    add_roadways_layer(m, _road_gdf)     # middle
+    add_truck_spots_layer(m, _spots_xy)  # top
+
+    folium.LayerControl(collapsed=False).add_to(m)
+    return m
+
+# ---------- chart spec ----------
+# Vega-Lite for the stacked hourly bars (what the Altair chart compiled to);
+# kept as a literal so reruns skip Altair's build/validation step
+STACKED_BARS_SPEC = {
+    "mark": {"type": "bar"},
+    "encoding": {
+        "x": {"field": "hour", "type": "ordinal", "title": "Hour of day"},
+        "y": {
+            "aggregate": "sum", "field": "value", "type": "quantitative",
+            "title": "Demand (truck-hours)", "axis": {"format": ",.0f"},
+        },
+        "color": {
+            "field": "type", "type": "nominal", "title": "",
+            "scale": {"domain": ["Designated", "Undesignated"]},
+            "sort": ["Designated", "Undesignated"],  # legend order
+        },
+        "order": {"field": "type_order", "type": "quantitative"},  # stack order: 0 -> 1
+        "tooltip": [
+            {"field": "hour", "type": "ordinal", "title": "Hour"},
+            {"field": "type", "type": "nominal", "title": "Type"},
+            {"aggregate": "sum", "field": "value", "type": "quantitative", "title": "Demand", "format": ",.0f"},
+        ],
+    },
+    "height": 400,
+}
+
 # ---------- UI ----------
 st.title("Indiana Truck Parking — County Dashboard")
 
@@ -229,37 +448,12 @@ with st.sidebar:
 # data
 daily = load_daily()
 counties = load_counties()
-hourly = load_hourly()
-spots_gdf, spots_err = load_spots(SPOTS_GEOJSON)
-road_gdf, road_err = load_roadways(ROADWAYS_GEOJSON)
-
-# join & fill
-gdf_joined = counties.merge(daily, on="county_fips", how="left")
-num_cols = [c for c in daily.columns if c not in ("diagnosis", "county_fips")]
-for c in num_cols:
-    if c in gdf_joined:
-        gdf_joined[c] = pd.to_numeric(gdf_joined[c], errors="coerce").fillna(0)
-
-# --- Create *_fmt (integer) columns for tooltip display only ---
-fmt_targets = [
-    "max_hourly_des_demand",
-    "max_hourly_undes_demand",
-    "max_hourly_total_demand",
-    "acc_des_demand",
-    "acc_undes_demand",
-    "acc_total_demand",
-    "supply",
-    "max_hourly_des_deficit",
-    "max_hourly_total_deficit",
-    "acc_des_deficit",
-    "acc_total_deficit",
-]
-for col in fmt_targets:
-    fmt_col = f"{col}_fmt"
-    if col in gdf_joined.columns:
-        gdf_joined[fmt_col] = gdf_joined[col].round(0).astype(int)
-    else:
-        gdf_joined[fmt_col] = 0
+hourly_statewide = load_hourly_statewide()
+spots_xy, spots_err = load_spots(SPOTS_PARQUET)
+road_gdf, road_err = load_roadways(ROADWAYS_PARQUET)
+
+# join & fill (+ *_fmt tooltip columns), cached
+gdf_joined = prepare_gdf(counties, daily)
 
 # optional notices if overlays missing
 if spots_err:
@@ -267,47 +461,37 @@ if spots_err:
 if road_err:
     st.info(road_err)
 
-# session state: selected county + ignore-next-click guard
+# session state: selected county + the map popup it came from / was cleared at
 if "selected_fips" not in st.session_state:
     st.session_state.selected_fips = None
-if "ignore_next_click" not in st.session_state:
-    st.session_state.ignore_next_click = False
+if "last_popup" not in st.session_state:
+    st.session_state.last_popup = None
+if "cleared_popup" not in st.session_state:
+    st.session_state.cleared_popup = None
 
 # layout
 col_map, col_chart = st.columns([3, 2], gap="large")
 
 with col_map:
-    if map_metric_label == "Diagnosis":
-        m = make_categorical_map(gdf_joined, "diagnosis")
-    else:
-        m = make_numeric_choropleth(
-            gdf_joined,
-            color_col=metric_label_to_key[map_metric_label],
-            legend_label=map_metric_label
-        )
-
-    # tooltip + popup on top of counties
-    attach_tooltip_and_popup(m, gdf_joined)
-
-    # --- Layer order: heatmap/categorical -> Roadways -> Spots ---
-    add_roadways_layer(m, road_gdf)     # middle
-    add_truck_spots_layer(m, spots_gdf) # top
-
-    folium.LayerControl(collapsed=False).add_to(m)
+    m = build_map(map_metric_label, gdf_joined, road_gdf, spots_xy)
     map_state = st_folium(
         m, height=650, use_container_width=True,
         returned_objects=["last_object_clicked_popup"]
     )
 
-# sanitize popup → fips, unless we're ignoring the next click (after a clear)
-if map_state and map_state.get("last_object_clicked_popup") and not st.session_state.ignore_next_click:
+# sanitize popup → fips, unless it's the (stale) popup that was just cleared;
+# st_folium keeps returning the last click until a new county is clicked
+if map_state and map_state.get("last_object_clicked_popup"):
     raw = str(map_state["last_object_clicked_popup"])
-    cleaned = re.sub(r"\D", "", raw).zfill(5)
-    st.session_state.selected_fips = cleaned
-
-# clear the guard once we've passed the read phase
-if st.session_state.ignore_next_click:
-    st.session_state.ignore_next_click = False
+    st.session_state.last_popup = raw
+    if raw != st.session_state.cleared_popup:
+        cleaned = re.sub(r"\D", "", raw).zfill(5)
+        st.session_state.selected_fips = cleaned
+        st.session_state.cleared_popup = None
+else:
+    # fresh map component (e.g. after a metric switch): nothing stale to guard
+    st.session_state.last_popup = None
+    st.session_state.cleared_popup = None
 
 # helper: fips → county name
 fips_to_name = dict(zip(gdf_joined["county_fips"], gdf_joined["county_name"]))
@@ -315,79 +499,40 @@ fips_to_name = dict(zip(gdf_joined["county_fips"], gdf_joined["county_name"]))
 with col_chart:
     st.markdown("### Hourly demand distribution (stacked)")
 
-    def hourly_long(df_hourly, fips=None):
-        if fips:
-            sub = df_hourly[df_hourly["county"] == fips].copy()
-            title = fips_to_name.get(fips, f"County {fips}")
-            # supply constant for this county from daily metrics
-            supply_const = float(daily.loc[daily["county_fips"] == fips, "supply"].fillna(0).max())
-        else:
-            sub = df_hourly.copy()
-            title = "Indiana (statewide)"
-            # statewide supply = sum of county supplies (constant across hours)
-            supply_const = float(daily["supply"].fillna(0).sum())
-
-        # aggregate demand by hour; set constant supply per hour
-        agg = sub.groupby("hour", as_index=False)[["des_demand", "undes_demand"]].sum()
-        agg["supply"] = supply_const
-
-        # long form for stacked bars (Designated bottom, Undesignated top)
-        long_df = agg.melt(
-            id_vars="hour",
-            value_vars=["des_demand", "undes_demand"],
-            var_name="type",
-            value_name="value"
-        ).replace({"type": {"des_demand": "Designated", "undes_demand": "Undesignated"}})
-
-        return title, long_df.sort_values("hour"), agg[["hour", "des_demand", "undes_demand", "supply"]]
-
-    title, bars_long, hourly_table = hourly_long(hourly, st.session_state.selected_fips)
-    st.write(f"**{title}**")
-
-    # enforce stack order + integer formatting for visuals
-    bars_long["type_order"] = bars_long["type"].map({"Designated": 0, "Undesignated": 1})
-
-    stacked = (
-        alt.Chart(bars_long)
-          .mark_bar()
-          .encode(
-              x=alt.X("hour:O", title="Hour of day"),
-              y=alt.Y("sum(value):Q", title="Demand (truck-hours)", axis=alt.Axis(format=",.0f")),
-              color=alt.Color(
-                  "type:N",
-                  title="",
-                  scale=alt.Scale(domain=["Designated", "Undesignated"]),
-                  sort=["Designated", "Undesignated"]  # legend order
-              ),
-              order=alt.Order("type_order:Q"),  # stack order: 0 -> 1
-              tooltip=[
-                  alt.Tooltip("hour:O", title="Hour"),
-                  alt.Tooltip("type:N", title="Type"),
-                  alt.Tooltip("sum(value):Q", title="Demand", format=",.0f")
-              ]
-          )
-          .properties(height=400)
-    )
-    st.altair_chart(stacked, use_container_width=True)
-
-    c1, c2 = st.columns(2)
-    with c1:
-        if st.button("Clear selection"):
-            st.session_state.selected_fips = None
-            st.session_state.ignore_next_click = True  # ignore the next map click event
-            st.rerun()
-    with c2:
-        # Download HOURLY (scoped to selection; default statewide)
-        # (Keep raw numeric precision in the CSV download)
-        csv_bytes = hourly_table.to_csv(index=False).encode("utf-8")
-        label = "Download hourly demand (statewide)" if st.session_state.selected_fips is None \
-                else f"Download hourly demand ({title})"
-        st.download_button(
-            label=label,
-            data=csv_bytes,
-            file_name="hourly_demand.csv",
-            mime="text/csv",
-        )
+    def _clear_selection():
+        st.session_state.selected_fips = None
+        # ignore the popup the map still reports until a new county is clicked
+        st.session_state.cleared_popup = st.session_state.last_popup
+
+    # Fragment: "Clear selection" / download reruns only this block, not the map.
+    # Reads the selection from session state (not an argument) so a
+    # fragment-only rerun sees the cleared value.
+    @st.fragment
+    def render_chart():
+        fips = st.session_state.selected_fips
+        title, bars_long, _ = bars_for(fips, hourly_statewide, fips_to_name)
+        st.write(f"**{title}**")
+
+        st.vega_lite_chart(bars_long, STACKED_BARS_SPEC, use_container_width=True)
+
+        c1, c2 = st.columns(2)
+        with c1:
+            # callback runs before the fragment reruns, so the chart redraws cleared
+            st.button("Clear selection", on_click=_clear_selection)
+        with c2:
+            # Download HOURLY (scoped to selection; default statewide)
+            # (Keep raw numeric precision in the CSV download)
+            csv_bytes = csv_bytes_for(fips, hourly_statewide, fips_to_name)
+            label = "Download hourly demand (statewide)" if fips is None \
+                    else f"Download hourly demand ({title})"
+            st.download_button(
+                label=label,
+                data=csv_bytes,
+                file_name="hourly_demand.csv",
+                mime="text/csv",
+            )
+
+    render_chart()
 
 with st.expander("Metrics & diagnosis"):
     st.markdown("""